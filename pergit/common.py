@@ -2,24 +2,60 @@
 Common utilities shared between sync and edit commands.
 """
 
+import contextlib
+import functools
+import io
+import locale
+import marshal
 import os
 import os.path
 import queue
+import shlex
 import subprocess
 import sys
 import threading
 from timeit import default_timer as timer
 from datetime import timedelta
 
+# Encoding of file names passed to and read from p4. p4 works with raw
+# bytes on POSIX, so use the file system encoding to let git's file names
+# through unchanged. On Windows p4 uses the ANSI code page, same as
+# subprocess text mode.
+if sys.platform == 'win32':
+    P4_ENCODING = locale.getpreferredencoding(False)
+else:
+    P4_ENCODING = sys.getfilesystemencoding()
+
+
+def p4_encode(text):
+    """Encode text, e.g. file names, to bytes for p4 input."""
+    return text.encode(P4_ENCODING, 'surrogateescape')
+
+
+def p4_decode(data):
+    """Decode bytes from p4 output, e.g. file names, to text."""
+    return data.decode(P4_ENCODING, 'surrogateescape')
+
 
 def is_workspace_dir(directory):
-    """Check if a directory is a git workspace."""
-    return os.path.isdir(os.path.join(directory, '.git'))
+    """
+    Check if a directory is a git workspace.
 
+    .git is a directory in a regular clone, but a file pointing to the real
+    git directory in worktrees and submodules, so accept either.
+    """
+    return os.path.exists(os.path.join(directory, '.git'))
 
-def get_workspace_dir():
-    """Find the git workspace root directory by walking up the directory tree."""
-    candidate_dir = os.getcwd()
+
+@functools.lru_cache(maxsize=None)
+def find_workspace_dir(start_dir):
+    """
+    Find the git workspace root directory by walking up the directory tree.
+
+    The result is cached per start directory, so repeated lookups don't
+    stat every parent directory again.
+    """
+    candidate_dir = start_dir
     while True:
         if is_workspace_dir(candidate_dir):
             return candidate_dir
@@ -30,6 +66,11 @@ def get_workspace_dir():
         candidate_dir = parent_dir
 
 
+def get_workspace_dir():
+    """Find the git workspace root directory of the current working directory."""
+    return find_workspace_dir(os.getcwd())
+
+
 def ensure_workspace():
     """Ensure we're in a git workspace and return the workspace directory."""
     workspace_dir = get_workspace_dir()
@@ -40,25 +81,60 @@ def ensure_workspace():
 
 
 class RunResult:
-    """Result of a command execution."""
+    """
+    Result of a command execution.
+
+    stdout and stderr are lists of lines. They may also be passed in as
+    a single string, which is then only split into lines if accessed.
+    """
 
     def __init__(self, returncode, stdout, stderr):
         self.returncode = returncode
-        self.stdout = stdout
-        self.stderr = stderr
+        self._stdout = stdout
+        self._stderr = stderr
 
+    @property
+    def stdout(self):
+        if isinstance(self._stdout, str):
+            self._stdout = self._stdout.splitlines()
+        return self._stdout
 
-def join_command_line(command):
-    command_line = ''
-    for c in command:
-        if c.find(' ') != -1:
-            command_line += ' "%s"' % c
-        else:
-            command_line += ' %s' % c
-    return command_line
+    @property
+    def stderr(self):
+        if isinstance(self._stderr, str):
+            self._stderr = self._stderr.splitlines()
+        return self._stderr
 
 
-def run(command, cwd='.', dry_run=False):
+def join_command_line(command):
+    """Join command arguments into a printable, shell quoted command line."""
+    # Same as shlex.join, which requires Python 3.8
+    return ' ' + ' '.join(shlex.quote(c) for c in command)
+
+
+def print_command(command, input=None):
+    """Print a command line, followed by its input lines if any."""
+    # Print command, input and newline in a single write, so output from
+    # concurrent runs doesn't get mixed up
+    echo = '> ' + join_command_line(command)
+    if input:
+        echo += ''.join('\n    ' + line for line in input.splitlines())
+    # File names that aren't valid in the file system encoding are printed
+    # escaped, e.g. bad\xffname, instead of failing the print
+    echo = os.fsencode(echo).decode(sys.getfilesystemencoding(), 'backslashreplace')
+    print(echo + '\n', end='')
+
+
+def print_elapsed(command, start_timestamp):
+    """Print the time elapsed since start_timestamp, naming the command."""
+    # Single write for the same reason as in print_command, and the command
+    # is repeated so the line can be told apart from those of other runs
+    elapsed = timedelta(seconds=timer() - start_timestamp)
+    print('Elapsed time is {} for{}\n'.format(elapsed, join_command_line(command)),
+          end='')
+
+
+def run(command, cwd='.', dry_run=False, input=None, encoding=None):
     """
     Run a command and return the result.
 
@@ -66,11 +142,15 @@ def run(command, cwd='.', dry_run=False):
         command: List of command arguments
         cwd: Working directory to run the command in
         dry_run: If True, only print the command without executing
+        input: Optional text to pass to the command on stdin
+        encoding: Optional encoding of input and output, instead of the
+                  locale encoding. Characters that can't be encoded or
+                  decoded are passed through with surrogateescape.
 
     Returns:
         RunResult object with returncode, stdout, and stderr
     """
-    print('>', join_command_line(command))
+    print_command(command, input)
 
     if dry_run:
         return RunResult(0, [], [])
@@ -79,23 +159,126 @@ def run(command, cwd='.', dry_run=False):
 
     result = subprocess.run(command,
                             cwd=cwd,
+                            input=input,
                             capture_output=True,
-                            text=True)
+                            text=True,
+                            encoding=encoding,
+                            errors='surrogateescape' if encoding else None)
+
+    print_elapsed(command, start_timestamp)
+
+    return RunResult(result.returncode, result.stdout, result.stderr)
+
+
+@contextlib.contextmanager
+def run_streaming(command, cwd='.'):
+    """
+    Start a command and stream its stdout, one line at a time.
+
+    Used as a context manager, the output is not buffered in memory and
+    each line can be handled as soon as it is written:
+
+        with run_streaming(command, cwd) as process:
+            for line in process.stdout:
+                ...
+        returncode = process.returncode
+
+    The command has finished, and its elapsed time is printed, once the
+    with block is left. stderr is not captured, it goes straight to the
+    terminal.
+
+    Args:
+        command: List of command arguments
+        cwd: Working directory to run the command in
+
+    Yields:
+        subprocess.Popen object with stdout as a text stream
+    """
+    print_command(command)
+
+    start_timestamp = timer()
+
+    with subprocess.Popen(command,
+                          cwd=cwd,
+                          stdout=subprocess.PIPE,
+                          text=True) as process:
+        yield process
+
+    print_elapsed(command, start_timestamp)
+
+
+def run_bytes(command, cwd='.', input=None):
+    """
+    Run a command and return the result with stdout left as raw bytes.
+
+    Meant for commands with binary or NUL separated output, e.g. git diff -z,
+    where decoding and splitting into lines would just be wasted work.
+
+    Args:
+        command: List of command arguments
+        cwd: Working directory to run the command in
+        input: Optional bytes to pass to the command on stdin
+
+    Returns:
+        RunResult object with returncode, stdout as bytes, and stderr
+    """
+    print_command(command)
+
+    start_timestamp = timer()
 
-    end_timestamp = timer()
+    result = subprocess.run(command,
+                            cwd=cwd,
+                            input=input,
+                            capture_output=True)
 
-    print('Elapsed time is', timedelta(seconds=end_timestamp - start_timestamp))
+    print_elapsed(command, start_timestamp)
 
-    return RunResult(result.returncode, result.stdout.splitlines(), result.stderr.splitlines())
+    return RunResult(result.returncode, result.stdout, os.fsdecode(result.stderr))
 
 
-def enqueue_lines(stream, output_queue):
-    """Enqueue lines from a stream into a queue."""
+def run_p4_marshaled(args, cwd='.', input=None):
+    """
+    Run a p4 command with -G and decode the marshaled records it outputs.
+
+    With -G p4 writes each result as a marshaled Python dict, and form
+    commands run with -i read their form as a marshaled dict as well.
+    Keys and values of the records are bytes, e.g. record[b'change'].
+
+    Args:
+        args: List of p4 arguments, without the leading 'p4 -G'
+        cwd: Working directory to run the command in
+        input: Optional bytes to pass to the command on stdin
+
+    Returns:
+        RunResult object with returncode, stdout as a list of dicts, and stderr lines
+    """
+    res = run_bytes(['p4', '-G'] + args, cwd=cwd, input=input)
+
+    records = []
+    stream = io.BytesIO(res.stdout)
+    while True:
+        try:
+            records.append(marshal.load(stream))
+        except EOFError:
+            break
+
+    return RunResult(res.returncode, records, res.stderr)
+
+
+def enqueue_lines(stream, stream_tag, output_queue):
+    """
+    Enqueue lines from a stream into a queue.
+
+    Each line is put as a (stream_tag, line) tuple, and (stream_tag, None)
+    is put once the stream is closed.
+    """
     for line in iter(stream.readline, ''):
-        output_queue.put(line.rstrip())
+        output_queue.put((stream_tag, line.rstrip()))
+    output_queue.put((stream_tag, None))
 
 
-def run_with_output(command, cwd='.', on_output=None):
+def run_with_output(command, cwd='.', on_output=None, input=None, *,
+                    capture_stdout=True, capture_stderr=True):
     """
     Run a command with real-time output processing.
 
@@ -105,11 +288,16 @@ def run_with_output(command, cwd='.', on_output=None):
         on_output: Callback function for processing output lines
                    If set the funciton will be called with each
                    line and stream (stdout/stderr) as they are written.
+        input: Optional text to pass to the command on stdin
+        capture_stdout: If False, stdout lines are only passed to on_output
+                        and not kept in the result
+        capture_stderr: If False, stderr lines are only passed to on_output
+                        and not kept in the result
 
     Returns:
         RunResult object with returncode, stdout, and stderr
     """
-    print('>', join_command_line(command))
+    print_command(command, input)
 
     start_timestamp = timer()
 
@@ -121,66 +309,58 @@ def run_with_output(command, cwd='.', on_output=None):
                           cwd=cwd,
                           stdout=subprocess.PIPE,
                           stderr=subprocess.PIPE,
-                          stdin=None,
+                          stdin=subprocess.PIPE if input is not None else None,
                           text=True) as process:
 
+        # Both reader threads feed the same queue, so the main thread can
+        # block on it instead of polling each stream
         output_queue = queue.Queue()
         out_thread = threading.Thread(
-            target=enqueue_lines, args=(process.stdout, output_queue))
+            target=enqueue_lines, args=(process.stdout, sys.stdout, output_queue))
         out_thread.daemon = True
 
-        error_queue = queue.Queue()
         err_thread = threading.Thread(
-            target=enqueue_lines, args=(process.stderr, error_queue))
+            target=enqueue_lines, args=(process.stderr, sys.stderr, output_queue))
         err_thread.daemon = True
 
         out_thread.start()
         err_thread.start()
 
-        def poll_queue_until_empty(q, lines, cb):
-            try:
-                while not q.empty():
-                    line = q.get_nowait()
-                    lines.append(line)
-                    if cb:
-                        cb(line)
-            except queue.Empty:
-                pass
         try:
-            def on_stdout(l): return on_output(
-                line=l, stream=sys.stdout) if on_output else None
-
-            def on_stderr(l): return on_output(
-                line=l, stream=sys.stderr) if on_output else None
-            while True:
-                poll_queue_until_empty(output_queue,
-                                       stdout_lines,
-                                       on_stdout)
-                poll_queue_until_empty(error_queue,
-                                       stderr_lines,
-                                       on_stderr)
-                if process.poll() is not None:
-                    if output_queue.empty() and error_queue.empty():
-                        break
+            # Output is drained by the reader threads meanwhile, so writing
+            # all input up front can't deadlock on full pipes
+            if input is not None:
+                try:
+                    process.stdin.write(input)
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+            open_streams = 2
+            while open_streams > 0:
+                try:
+                    # Wake up now and then so CTRL-C is noticed on all platforms
+                    stream, line = output_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+
+                if line is None:
+                    open_streams -= 1
+                    continue
+
+                if stream is sys.stdout:
+                    if capture_stdout:
+                        stdout_lines.append(line)
+                elif capture_stderr:
+                    stderr_lines.append(line)
+                if on_output:
+                    on_output(line=line, stream=stream)
 
             # Wait for threads to finish
             out_thread.join()
             err_thread.join()
 
-            (final_stdout, final_stderr) = process.communicate()
-            returncode = process.returncode
-
-            if final_stdout:
-                final_stdout_lines = final_stdout.splitlines()
-                stdout_lines = stdout_lines + final_stdout_lines
-                for l in final_stdout_lines:
-                    on_stdout(l)
-
-            if final_stderr:
-                final_stderr_lines = final_stderr.splitlines()
-                stderr_lines = stderr_lines + final_stderr_lines
-                for l in final_stderr_lines:
-                    on_stderr(l)
+            returncode = process.wait()
 
         except KeyboardInterrupt:
             print("CTRL-C pressed, terminate subprocess")
@@ -190,10 +370,9 @@ def run_with_output(command, cwd='.', on_output=None):
             except subprocess.TimeoutExpired:
                 print("Subprocess did not terminate in time. Forcing kill...")
                 process.kill()
-            sys.exit(1)
-
-    end_timestamp = timer()
+            # Let the caller, ultimately main(), deal with the cancellation
+            raise
 
-    print('Elapsed time is', timedelta(seconds=end_timestamp - start_timestamp))
+    print_elapsed(command, start_timestamp)
 
     return RunResult(returncode, stdout_lines, stderr_lines)
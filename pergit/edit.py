@@ -2,12 +2,18 @@
 Edit command implementation for pergit.
 """
 
+import concurrent.futures
+import marshal
+import os
 import re
 import sys
-import subprocess
-from .common import ensure_workspace, run
+from .common import (P4_ENCODING, ensure_workspace, p4_decode, p4_encode, run, run_bytes,
+                     run_p4_marshaled)
 from .list_changes import get_enumerated_change_description_since
 
+# Output of p4 change -i, e.g. "Change 12345 created."
+_CHANGE_CREATED_RE = re.compile(r'Change (\d+) created')
+
 
 class LocalChanges:
     """Container for local git changes."""
@@ -18,38 +24,83 @@ class LocalChanges:
         self.dels = []
         self.moves = []
 
+    def is_empty(self):
+        """Check if there are no changes at all."""
+        return not (self.adds or self.mods or self.dels or self.moves)
+
 
-def check_file_status(filename, workspace_dir):
+def get_opened_map(filenames, workspace_dir):
     """
-    Check if a file is already checked out in Perforce and return its changelist.
+    Find out which of the given files are already opened in Perforce.
+
+    All files are checked with a single p4 fstat, instead of running one
+    p4 opened per file. Only opened files are reported back by p4, so the
+    output stays small even when few of the files are opened.
 
     Args:
-        filename: The file to check
+        filenames: List of files to check
         workspace_dir: The workspace directory
 
     Returns:
-        changelist_number or None
-        changelist_number is None if file is not checked out
+        Dict mapping filename to changelist number (or 'default') for each
+        file that is opened. Files that are not opened are left out.
     """
-    res = run(['p4', 'opened', filename], cwd=workspace_dir)
-
-    # Check if file is not opened (p4 opened always returns 0, so check output)
-    if not res.stdout or any('file(s) not opened on this client' in line for line in res.stdout):
-        return None
-
-    # Parse the output to extract changelist number
-    # Format: "//depot/path/file#1 - edit change 12345 (text) by user@workspace"
-    for line in res.stdout:
-        if '- edit default change ' in line:
-            return 'default'
-        if '- edit change ' in line:
-            # Extract changelist number using regex
-            match = re.search(r'change (\d+)', line)
-            if match:
-                return match.group(1)
+    if not filenames:
+        return {}
+
+    # Only resolve the directory, a file symlink must keep its own name or
+    # it would be mixed up with its target if both are in the list
+    def normalize(path):
+        directory, name = os.path.split(path)
+        return os.path.normcase(os.path.join(os.path.realpath(directory), name))
+
+    local_paths = {}
+    for filename in filenames:
+        local_paths[normalize(os.path.join(workspace_dir, filename))] = filename
+
+    res = run_p4_marshaled(['-x', '-', 'fstat', '-Ro', '-T', 'clientFile,change'],
+                           cwd=workspace_dir,
+                           input=p4_encode('\n'.join(filenames) + '\n'))
+
+    # One record per opened file, e.g.
+    # {b'code': b'stat', b'clientFile': b'/path/to/workspace/file', b'change': b'12345'}
+    opened_map = {}
+    for record in res.stdout:
+        if b'clientFile' not in record or b'change' not in record:
+            continue
+        filename = local_paths.get(normalize(p4_decode(record[b'clientFile'])))
+        if filename is not None:
+            opened_map[filename] = p4_decode(record[b'change'])
+
+    return opened_map
+
+
+def p4_batch(command, filenames, changelist, workspace_dir, dry_run=False):
+    """
+    Run a p4 command on a batch of files in a single invocation.
+
+    Filenames are passed to p4 on stdin with -x, so the whole batch costs one
+    process spawn and one server round-trip.
+
+    Args:
+        command: The p4 command to run, e.g. 'add' or 'edit'
+        filenames: List of files to pass to the command
+        changelist: The changelist to open the files in
+        workspace_dir: The workspace directory
+        dry_run: If True, only print the command and files
 
-    # If we get here, file is checked out but we couldn't parse the changelist
-    return None
+    Returns:
+        RunResult object with returncode, stdout, and stderr
+    """
+    res = run(['p4', '-x', '-', command, '-c', changelist],
+              cwd=workspace_dir, dry_run=dry_run,
+              input='\n'.join(filenames) + '\n', encoding=P4_ENCODING)
+    # Batches run concurrently, so print all errors in a single write and
+    # tag each line with the command it came from
+    if res.stderr:
+        print(''.join('p4 %s: %s\n' % (command, line) for line in res.stderr),
+              end='', file=sys.stderr)
+    return res
 
 
 def find_common_ancestor(branch1, branch2, workspace_dir):
@@ -75,18 +126,17 @@ def find_common_ancestor(branch1, branch2, workspace_dir):
     return (0, res.stdout[0].strip())
 
 
-def get_local_git_changes(base_branch, workspace_dir):
+def find_base_commit(base_branch, workspace_dir):
     """
-    Get local git changes between base_branch and HEAD using common ancestor logic.
+    Find the common ancestor between base_branch and HEAD.
 
     Args:
         base_branch: The base branch to compare against
         workspace_dir: The git workspace directory
 
     Returns:
-        Tuple of (returncode, LocalChanges object or None)
+        Tuple of (returncode, common_ancestor_commit_hash or None)
     """
-    # Always find common ancestor between base_branch and current HEAD
     returncode, ancestor = find_common_ancestor(
         base_branch, 'HEAD', workspace_dir)
     if returncode != 0:
@@ -99,55 +149,119 @@ def get_local_git_changes(base_branch, workspace_dir):
               f'This usually means the branches have completely different histories.', file=sys.stderr)
         return (1, None)
 
+    return (0, ancestor)
+
+
+def get_local_git_changes(base_branch, workspace_dir):
+    """
+    Get local git changes between base_branch and HEAD using common ancestor logic.
+
+    Args:
+        base_branch: The base branch to compare against
+        workspace_dir: The git workspace directory
+
+    Returns:
+        Tuple of (returncode, LocalChanges object or None)
+    """
+    # Always find common ancestor between base_branch and current HEAD
+    returncode, ancestor = find_base_commit(base_branch, workspace_dir)
+    if returncode != 0:
+        return (returncode, None)
+
+    return get_git_changes_since(ancestor, workspace_dir)
+
+
+def get_changes_and_description(base_branch, workspace_dir):
+    """
+    Get local git changes and an enumerated changelist description since base_branch.
+
+    The common ancestor with HEAD is only looked up once and used for both.
+
+    Args:
+        base_branch: The base branch to compare against
+        workspace_dir: The git workspace directory
+
+    Returns:
+        Tuple of (returncode, LocalChanges object or None, description_string or None)
+    """
+    returncode, ancestor = find_base_commit(base_branch, workspace_dir)
+    if returncode != 0:
+        return (returncode, None, None)
+
+    returncode, changes = get_git_changes_since(ancestor, workspace_dir)
+    if returncode != 0:
+        return (returncode, None, None)
+
+    # No need for a description if there is nothing to put in a changelist
+    if changes.is_empty():
+        return (0, changes, None)
+
+    returncode, description = get_enumerated_change_description_since(
+        ancestor, workspace_dir)
+    if returncode != 0:
+        return (returncode, None, None)
+
+    return (0, changes, description)
+
+
+def get_git_changes_since(ancestor, workspace_dir):
+    """
+    Get files changed between the ancestor commit and HEAD.
+
+    Args:
+        ancestor: The commit to compare against
+        workspace_dir: The git workspace directory
+
+    Returns:
+        Tuple of (returncode, LocalChanges object or None)
+    """
     # Diff base_branch against the common ancestor to find files that changed on base_branch
-    # but not on the current branch
-    res = run(['git', 'diff', '--name-status', '{}..{}'.format(ancestor, 'HEAD')],
-              cwd=workspace_dir)
+    # but not on the current branch.
+    # With -z each status and filename is NUL terminated, and filenames are not quoted:
+    # M\0file\0A\0file\0R100\0from_file\0to_file\0
+    res = run_bytes(['git', 'diff', '-z', '--name-status', '{}..{}'.format(ancestor, 'HEAD')],
+                    cwd=workspace_dir)
 
     if res.returncode != 0:
         return (res.returncode, None)
 
     changes = LocalChanges()
-    renamepattern = r"^r(\d+)$"
-    for line in res.stdout:
-        tokens = line.split('\t')
-        status = tokens[0].lower()
-        filename = tokens[1]
-        if status == 'm':
+    tokens = iter(res.stdout.split(b'\0'))
+    for status in tokens:
+        if not status:
+            # Trailing NUL
+            continue
+        filename = os.fsdecode(next(tokens))
+        if status == b'M':
             changes.mods.append(filename)
-        elif status == 'd':
+        elif status == b'D':
             changes.dels.append(filename)
-        elif status == 'a':
+        elif status == b'A':
             changes.adds.append(filename)
-        elif re.search(renamepattern, status):
+        elif status.startswith(b'R'):
             from_filename = filename
-            to_filename = tokens[2]
+            to_filename = os.fsdecode(next(tokens))
             changes.moves.append((from_filename, to_filename))
         else:
-            print('Unknown git status in "{}"'.format(line), file=sys.stderr)
+            print('Unknown git status "{}" for "{}"'.format(status.decode(), filename),
+                  file=sys.stderr)
             return (1, None)
 
     return (0, changes)
 
 
-def create_new_changelist(base_branch, workspace_dir, dry_run=False):
+def create_new_changelist(description, workspace_dir, dry_run=False):
     """
-    Create a new Perforce changelist with description from git log.
+    Create a new Perforce changelist.
 
     Args:
-        base_branch: The base branch to compare against for description
+        description: Changelist description, e.g. from get_changes_and_description
         workspace_dir: The workspace directory
         dry_run: If True, don't actually create the changelist
 
     Returns:
         Tuple of (returncode, changelist_number or None)
     """
-    # Get changelist description
-    returncode, description = get_enumerated_change_description_since(
-        base_branch, workspace_dir)
-    if returncode != 0:
-        return (returncode, None)
-
     # If no description, use a default
     if not description:
         description = "New changelist created by pergit"
@@ -158,38 +272,35 @@ def create_new_changelist(base_branch, workspace_dir, dry_run=False):
         print(description)
         return (0, "new")
 
-    # Prepare the changelist spec content
-    spec_content = f"Change: new\n\nDescription:\n\t{description}\n"
+    # Pass the changelist form to p4 change as a marshaled dict, that way
+    # p4 takes care of multi-line descriptions
+    spec = {b'Change': b'new', b'Description': p4_encode(description)}
 
-    # Create the changelist using p4 change, pass description via stdin
     try:
-        result = subprocess.run(
-            ['p4', 'change', '-i'],
-            cwd=workspace_dir,
-            input=spec_content,
-            capture_output=True,
-            text=True
-        )
-
-        if result.returncode != 0:
+        res = run_p4_marshaled(['change', '-i'], cwd=workspace_dir,
+                               input=marshal.dumps(spec, 0))
+
+        errors = [p4_decode(record[b'data']).rstrip() for record in res.stdout
+                  if record.get(b'code') == b'error']
+        if res.returncode != 0 or errors:
             print('Failed to create new changelist', file=sys.stderr)
-            print(result.stderr, file=sys.stderr)
-            return (result.returncode, None)
+            for line in errors + res.stderr:
+                print(line, file=sys.stderr)
+            return (res.returncode or 1, None)
 
-        # Extract changelist number from output
+        # Extract changelist number from the info record
         # Format: "Change 12345 created."
         changelist_number = None
-        for line in result.stdout.splitlines():
-            if 'Change' in line and 'created' in line:
-                match = re.search(r'Change (\d+) created', line)
-                if match:
-                    changelist_number = match.group(1)
-                    break
+        for record in res.stdout:
+            match = _CHANGE_CREATED_RE.search(p4_decode(record.get(b'data', b'')))
+            if match:
+                changelist_number = match.group(1)
+                break
 
         if changelist_number is None:
             print(
                 'Failed to extract changelist number from p4 change output', file=sys.stderr)
-            print('Output:', result.stdout, file=sys.stderr)
+            print('Output:', res.stdout, file=sys.stderr)
             return (1, None)
 
         return (0, changelist_number)
@@ -199,6 +310,86 @@ def create_new_changelist(base_branch, workspace_dir, dry_run=False):
         return (1, None)
 
 
+def _run_many(batches, changelist, workspace_dir, dry_run=False):
+    """
+    Run independent p4 batches concurrently.
+
+    Each batch operates on a different set of files, so they can be sent
+    to the server at the same time, hiding the round-trip latency of all
+    but one of them.
+
+    Args:
+        batches: List of (command, filenames) tuples
+        changelist: The changelist to open the files in
+        workspace_dir: The workspace directory
+        dry_run: If True, only print the commands and files
+
+    Returns:
+        List of RunResult objects, in the same order as batches
+    """
+    if not batches:
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(batches)) as executor:
+        futures = [executor.submit(p4_batch, command, filenames, changelist,
+                                   workspace_dir, dry_run=dry_run)
+                   for command, filenames in batches]
+        return [future.result() for future in futures]
+
+
+def include_changes_in_changelist(changes, changelist, workspace_dir, dry_run=False,
+                                  opened_map=None):
+    """
+    Open local git changes for add, edit or delete in a Perforce changelist.
+
+    Each kind of change is handled with one batched p4 command, and the
+    batches are run concurrently.
+
+    Args:
+        changes: LocalChanges object
+        changelist: The changelist to open the files in
+        workspace_dir: The workspace directory
+        dry_run: If True, only print the commands
+        opened_map: Result of get_opened_map for changes.mods, if already known
+
+    Returns:
+        Exit code (0 for success, non-zero for failure)
+    """
+    if changes.is_empty():
+        return 0
+
+    # Moved/renamed files are deleted at the old path and added at the new one
+    adds = changes.adds + [to_filename for _, to_filename in changes.moves]
+    dels = changes.dels + [from_filename for from_filename, _ in changes.moves]
+
+    # Modified files already opened in another changelist are reopened,
+    # files already in the target changelist are left as is
+    if opened_map is None:
+        opened_map = get_opened_map(changes.mods, workspace_dir)
+    edits = [f for f in changes.mods if f not in opened_map]
+    reopens = [f for f in changes.mods
+               if f in opened_map and opened_map[f] != changelist]
+
+    batches = [
+        ('add', adds, 'Failed to add files to perforce'),
+        ('edit', edits, 'Failed to open files for edit in perforce'),
+        ('reopen', reopens, 'Failed to reopen files in perforce'),
+        ('delete', dels, 'Failed to delete files from perforce'),
+    ]
+    batches = [batch for batch in batches if batch[1]]
+    results = _run_many([(command, filenames) for command, filenames, _ in batches],
+                        changelist, workspace_dir, dry_run=dry_run)
+
+    returncode = 0
+    for (_, _, error_message), res in zip(batches, results):
+        if res.returncode != 0:
+            print(error_message, file=sys.stderr)
+            if returncode == 0:
+                returncode = res.returncode
+
+    return returncode
+
+
 def edit_command(args):
     """
     Execute the edit command.
@@ -214,8 +405,25 @@ def edit_command(args):
     # Handle 'new' changelist creation
     changelist = args.changelist
     if args.changelist.lower() == 'new':
-        returncode, changelist = create_new_changelist(
-            args.base_branch, workspace_dir, dry_run=args.dry_run)
+        returncode, changes, description = get_changes_and_description(
+            args.base_branch, workspace_dir)
+        if returncode != 0:
+            print('Failed to get a list of changed files', file=sys.stderr)
+            return returncode
+
+        if changes.is_empty():
+            print('No changes found, not creating a new changelist')
+            return 0
+
+        # Files may already be opened in other changelists, also when the target
+        # changelist is new. Finding them doesn't need the changelist number,
+        # so look them up while the changelist is being created.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            opened_future = executor.submit(
+                get_opened_map, changes.mods, workspace_dir)
+            returncode, changelist = create_new_changelist(
+                description, workspace_dir, dry_run=args.dry_run)
+            opened_map = opened_future.result()
         if returncode != 0:
             print('Failed to create new changelist', file=sys.stderr)
             return returncode
@@ -225,61 +433,17 @@ def edit_command(args):
             # For dry run, we still need to continue to show what would be edited
         else:
             print(f"Created new changelist: {changelist}")
+    else:
+        opened_map = None
+        returncode, changes = get_local_git_changes(
+            args.base_branch, workspace_dir)
+        if returncode != 0:
+            print('Failed to get a list of changed files', file=sys.stderr)
+            return returncode
 
-    returncode, changes = get_local_git_changes(
-        args.base_branch, workspace_dir)
-    if returncode != 0:
-        print('Failed to get a list of changed files', file=sys.stderr)
-        return returncode
-
-    # Process added files
-    for filename in changes.adds:
-        res = run(['p4', 'add', '-c', changelist, filename],
-                  cwd=workspace_dir, dry_run=args.dry_run)
-        if res.returncode != 0:
-            print('Failed to add file to perforce', file=sys.stderr)
-            return res.returncode
-
-    # Process modified files
-    for filename in changes.mods:
-        # Check if file is already checked out
-        current_changelist = check_file_status(filename, workspace_dir)
-
-        if current_changelist is None:
-            # File is not checked out, use p4 edit
-            res = run(['p4', 'edit', '-c', changelist, filename],
-                      cwd=workspace_dir, dry_run=args.dry_run)
-            if res.returncode != 0:
-                print('Failed to open file for edit in perforce', file=sys.stderr)
-                return res.returncode
-        elif current_changelist != changelist:
-            # File is checked out in different changelist, use p4 reopen
-            res = run(['p4', 'reopen', '-c', changelist, filename],
-                      cwd=workspace_dir, dry_run=args.dry_run)
-            if res.returncode != 0:
-                print('Failed to reopen file in perforce', file=sys.stderr)
-                return res.returncode
-        # If current_changelist == changelist, file is already in correct changelist, do nothing
-
-    # Process deleted files
-    for filename in changes.dels:
-        res = run(['p4', 'delete', '-c', changelist, filename],
-                  cwd=workspace_dir, dry_run=args.dry_run)
-        if res.returncode != 0:
-            print('Failed to delete file from perforce', file=sys.stderr)
-            return res.returncode
-
-    # Process moved/renamed files
-    for from_filename, to_filename in changes.moves:
-        res = run(['p4', 'delete', '-c', changelist, from_filename],
-                  cwd=workspace_dir, dry_run=args.dry_run)
-        if res.returncode != 0:
-            print('Failed to delete from-file in perforce', file=sys.stderr)
-            return res.returncode
-        res = run(['p4', 'add', '-c', changelist, to_filename],
-                  cwd=workspace_dir, dry_run=args.dry_run)
-        if res.returncode != 0:
-            print('Failed to add file to-file to perforce', file=sys.stderr)
-            return res.returncode
+        if changes.is_empty():
+            print('No changes found')
+            return 0
 
-    return 0
+    return include_changes_in_changelist(changes, changelist, workspace_dir,
+                                         dry_run=args.dry_run, opened_map=opened_map)
@@ -3,7 +3,13 @@ List-changes command implementation for pergit.
 """
 
 import sys
-from .common import ensure_workspace, run
+from .common import ensure_workspace, run, run_streaming
+
+
+def get_commit_subjects_command(base_branch):
+    """Get the git log command that lists commit subjects since base branch."""
+    # Using --reverse to get oldest commits first
+    return ['git', 'log', '--reverse', '--format=%s', '{}..HEAD'.format(base_branch)]
 
 
 def get_commit_subjects_since(base_branch, workspace_dir):
@@ -17,25 +23,12 @@ def get_commit_subjects_since(base_branch, workspace_dir):
     Returns:
         Tuple of (returncode, list_of_subjects or None)
     """
-    # Run git log to get commit subjects since base branch
-    # Using --reverse to get oldest commits first
-    res = run(['git', 'log', '--oneline', '--reverse', '{}..HEAD'.format(base_branch)],
-              cwd=workspace_dir)
+    res = run(get_commit_subjects_command(base_branch), cwd=workspace_dir)
 
     if res.returncode != 0:
         return (res.returncode, None)
 
-    # Extract just the subjects (everything after the hash and space)
-    subjects = []
-    for line in res.stdout:
-        if ' ' in line:
-            subject = line.split(' ', 1)[1]
-            subjects.append(subject)
-        else:
-            # Fallback if format is unexpected
-            subjects.append(line)
-
-    return (0, subjects)
+    return (0, res.stdout)
 
 
 def get_enumerated_change_description_since(base_branch, workspace_dir):
@@ -76,15 +69,19 @@ def list_changes_command(args):
     """
     workspace_dir = ensure_workspace()
 
-    returncode, description = get_enumerated_change_description_since(
-        args.base_branch, workspace_dir)
-    if returncode != 0:
+    # Print each subject as git writes it, instead of collecting the whole log first
+    count = 0
+    with run_streaming(get_commit_subjects_command(args.base_branch),
+                       cwd=workspace_dir) as process:
+        for count, line in enumerate(process.stdout, 1):
+            subject = line.rstrip('\n')
+            print(f"{count}. {subject}")
+
+    if process.returncode != 0:
         print('Failed to get commit list', file=sys.stderr)
-        return returncode
+        return process.returncode
 
-    if description:
-        print(description)
-    else:
+    if count == 0:
         print("No changes found")
 
     return 0
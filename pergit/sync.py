@@ -4,13 +4,40 @@ Sync command implementation for pergit.
 
 import os
 import re
+import stat
 import subprocess
 import sys
 import time
 from timeit import default_timer as timer
 from datetime import timedelta
 
-from .common import ensure_workspace, run, run_with_output
+from .common import ensure_workspace, run, run_streaming, run_with_output
+
+# Reported by p4 sync when there is nothing to sync, e.g. "//...@12345 - file(s) up-to-date."
+_UP_TO_DATE_RE = re.compile(r"//\.\.\.@\d+ - file\(s\) up-to-date\.")
+
+# Mode and separator of each kind of line written by p4 sync, e.g.
+# "//depot/file#1 - updating /path/to/file"
+# "//depot/file#1 - added as /path/to/file"
+# "//depot/file#1 - deleted as /path/to/file"
+# "Can't clobber writable file /path/to/file"
+# Updates are by far the most common, so they are checked first.
+_P4_SYNC_PATTERNS = (
+    ('upd', ' - updating '),
+    ('add', ' - added as '),
+    ('del', ' - deleted as '),
+    ('clb', "Can't clobber writable file "),
+)
+
+# Terminal escape codes for green text
+_GREEN = '\033[92m'
+_RESET = '\033[0m'
+
+# Commit message written by sync_command, e.g. "12345: p4 sync //...@12345"
+_CHANGELIST_RE = re.compile(r"(\d+): p4 sync //\.\.\.@\1")
+
+# Changelist number in the output of p4 changes
+_CHANGE_RE = re.compile(r'Change (\d+)')
 
 
 def echo_output_to_stream(line, stream):
@@ -18,77 +45,60 @@ def echo_output_to_stream(line, stream):
     print(line, file=stream)
 
 
-def get_writable_files(stderr_lines):
-    """Extract writable files from p4 sync stderr output."""
-    cant_clobber_prefix = "Can't clobber writable file "
-    writable_files = []
-    for line in stderr_lines:
-        if not line.startswith(cant_clobber_prefix):
-            continue
-        writable_file = line[len(cant_clobber_prefix):]
-        writable_files.append(writable_file.rstrip())
-    return writable_files
-
-
 def parse_p4_sync_line(line):
-    """Parse a line from p4 sync output."""
-    patterns = [
-        ('add', ' - added as '),
-        ('del', ' - deleted as '),
-        ('upd', ' - updating '),
-        ('clb', "Can't clobber writable file ")
-    ]
-    for mode, pattern in patterns:
-        tokens = line.split(pattern)
-        if len(tokens) == 2:
-            return (mode, tokens[1])
+    """Parse a line from p4 sync output into a (mode, filename) tuple."""
+    for mode, pattern in _P4_SYNC_PATTERNS:
+        _, separator, filename = line.partition(pattern)
+        if separator:
+            return (mode, filename)
 
     return (None, None)
 
 
 def get_file_size(filename):
-    """Get the size of a file in bytes."""
-    if not os.path.isfile(filename):
+    """Get the size of a file in bytes, 0 if it doesn't exist."""
+    # A single stat, instead of one for isfile and one for the size
+    try:
+        file_stats = os.stat(filename)
+    except OSError:
         return 0
-    file_stats = os.stat(filename)
-    return file_stats.st_size if file_stats else 0
-
+    return file_stats.st_size if stat.S_ISREG(file_stats.st_mode) else 0
 
-def green_text(s):
-    """Format text in green color."""
-    return f'\033[92m{s}\033[0m'
 
-
-class SyncStats:
-    """Statistics for sync operations."""
-
-    def __init__(self):
-        self.count = 0
-        self.total_size = 0
+_SIZE_UNITS = ('', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi')
 
 
 def readable_file_size(num, suffix="B"):
     """Convert bytes to human readable format."""
-    for unit in ('', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi'):
-        if abs(num) < 1024.0:
-            return f'{num:3.1f}{unit}{suffix}'
-        num /= 1024.0
-    return f'{num:.1f}Yi{suffix}'
+    # Each unit is 2^10 times the previous one, so the unit can be picked
+    # from the bit length directly instead of dividing until it fits
+    unit_index = min(max(int(abs(num)).bit_length() - 1, 0) // 10,
+                     len(_SIZE_UNITS) - 1)
+    return f'{num / (1 << (10 * unit_index)):3.1f}{_SIZE_UNITS[unit_index]}{suffix}'
 
 
 class P4SyncOutputProcessor:
     """Process p4 sync output in real-time."""
 
+    # Running sync stats are printed at most once per this many files or seconds
+    STATS_INTERVAL_FILE_COUNT = 100
+    STATS_INTERVAL_SEC = 0.5
+
     def __init__(self, file_count_to_sync):
         self.start_timestamp = timer()
+        self.stats_timestamp = self.start_timestamp
+        self.file_count_since_stats = 0
         self.synced_file_count = 0
         self.file_count_to_sync = file_count_to_sync
-        self.stats = {}
-        for mode in ['add', 'del', 'upd', 'clb']:
-            self.stats[mode] = SyncStats()
+        # File count and total size per mode
+        self.add_count = self.del_count = self.upd_count = self.clb_count = 0
+        self.add_size = self.del_size = self.upd_size = self.clb_size = 0
+        # Files p4 refused to sync because they are writable
+        self.writable_files = []
 
     def __call__(self, line, stream):
-        if re.search(r"//...@\d+ - file\(s\) up-to-date\.", line):
+        # Cheap substring test first, at most one line per sync is up-to-date
+        if 'up-to-date' in line and _UP_TO_DATE_RE.search(line):
             print('All files are up to date')
             return
 
@@ -97,34 +107,51 @@ class P4SyncOutputProcessor:
             print(f'Unparsable line: {line}')
             return
 
-        if mode in self.stats:
-            self.stats[mode].count += 1
+        size = None
+        if mode == 'upd':
+            size = get_file_size(filename)
+            self.upd_count += 1
+            self.upd_size += size
+        elif mode == 'add':
+            size = get_file_size(filename)
+            self.add_count += 1
+            self.add_size += size
+        elif mode == 'del':
+            self.del_count += 1
+        elif mode == 'clb':
+            size = get_file_size(filename)
+            self.clb_count += 1
+            self.clb_size += size
+            self.writable_files.append(filename)
         self.synced_file_count += 1
 
-        print('{}: {}'.format(green_text(mode), filename))
-
+        # Build all output for the line first and write it in one go
         indentation = '     '
+        parts = [f'{_GREEN}{mode}{_RESET}: {filename}\n']
         if self.file_count_to_sync >= 0:
-            print('{}progress: {} / {}'.format(indentation,
-                                               self.synced_file_count,
-                                               self.file_count_to_sync))
+            parts.append(f'{indentation}progress: {self.synced_file_count} / '
+                         f'{self.file_count_to_sync}\n')
 
-        if mode in ['add', 'upd', 'clb']:
-            size = get_file_size(filename)
-            self.stats[mode].total_size += size
-            print('{}size: {}'.format(indentation, readable_file_size(size)))
+        if size is not None:
+            parts.append(f'{indentation}size: {readable_file_size(size)}\n')
+
+        self.file_count_since_stats += 1
+        now = timer()
+        if (self.file_count_since_stats >= self.STATS_INTERVAL_FILE_COUNT or
+                now - self.stats_timestamp >= self.STATS_INTERVAL_SEC):
+            parts.append(f'{indentation}sync stats {self.get_sync_stats()}\n')
+            self.file_count_since_stats = 0
+            self.stats_timestamp = now
 
-        print('{}sync stats {}'.format(indentation, self.get_sync_stats()))
+        sys.stdout.write(''.join(parts))
 
     def get_sync_stats(self):
         """Get current sync statistics."""
         duration_sec = timer() - self.start_timestamp
         duration = timedelta(seconds=duration_sec)
 
-        synced_count = self.stats['add'].count + \
-            self.stats['upd'].count - self.stats['clb'].count
-        synced_size = self.stats['add'].total_size + \
-            self.stats['upd'].total_size - self.stats['clb'].total_size
+        synced_count = self.add_count + self.upd_count - self.clb_count
+        synced_size = self.add_size + self.upd_size - self.clb_size
 
         return 'file count {}, size {}, time {}, average speed {} / sec'.format(
             synced_count,
@@ -137,30 +164,39 @@ class P4SyncOutputProcessor:
         sync_stats = self.get_sync_stats()
         print(f'Sync stats: {sync_stats}')
 
-        for mode, stat in self.stats.items():
+        for mode, count, size in (('add', self.add_count, self.add_size),
+                                  ('del', self.del_count, self.del_size),
+                                  ('upd', self.upd_count, self.upd_size),
+                                  ('clb', self.clb_count, self.clb_size)):
             print(f'{mode}')
-            print(f'  count: {stat.count}')
-            print('  size : {}'.format(readable_file_size(stat.total_size)))
-
-
-def p4_force_sync_file(changelist, filename, workspace_dir):
-    """Force sync a single file."""
-    output_processor = P4SyncOutputProcessor(-1)
-    res = run_with_output(['p4', 'sync', '-f', '%s@%s' %
-                          (filename, changelist)], cwd=workspace_dir, on_output=output_processor)
+            print(f'  count: {count}')
+            print('  size : {}'.format(readable_file_size(size)))
+
+
+def p4_force_sync_files(changelist, filenames, workspace_dir):
+    """Force sync a list of files with a single p4 sync."""
+    output_processor = P4SyncOutputProcessor(len(filenames))
+    res = run_with_output(['p4', '-x', '-', 'sync', '-f'], cwd=workspace_dir,
+                          on_output=output_processor,
+                          input=''.join('%s@%s\n' % (filename, changelist)
+                                        for filename in filenames),
+                          capture_stdout=False, capture_stderr=False)
     output_processor.print_stats()
     return res.returncode
 
 
 def get_file_count_to_sync(changelist, workspace_dir):
     """Get the number of files that need to be synced."""
-    res = run(['p4', 'sync', '-n', '//...@%s' %
-              (changelist)], cwd=workspace_dir)
+    # Only the number of lines is needed, so count them as they arrive
+    # instead of keeping the whole preview in memory
+    with run_streaming(['p4', 'sync', '-n', '//...@%s' %
+                        (changelist)], cwd=workspace_dir) as process:
+        file_count = sum(1 for _ in process.stdout)
 
-    if res.returncode != 0:
+    if process.returncode != 0:
         return -1
 
-    return len(res.stdout)
+    return file_count
 
 
 def p4_sync(changelist, force, workspace_dir):
@@ -173,19 +209,21 @@ def p4_sync(changelist, force, workspace_dir):
         return True
     print(f'Syncing {file_count_to_sync} files')
 
+    # The output processor picks up everything needed from the output as
+    # it arrives, so don't keep a copy of every line of a large sync
     output_processor = P4SyncOutputProcessor(file_count_to_sync)
     res = run_with_output(['p4', 'sync', '//...@%s' %
-                          (changelist)], cwd=workspace_dir, on_output=output_processor)
+                          (changelist)], cwd=workspace_dir, on_output=output_processor,
+                          capture_stdout=False, capture_stderr=False)
     output_processor.print_stats()
     if res.returncode == 0:
         return True
 
-    writable_files = get_writable_files(res.stderr)
+    writable_files = output_processor.writable_files
     print('Found %d writable files' % len(writable_files))
     if force:
-        for filename in writable_files:
-            if p4_force_sync_file(changelist, filename, workspace_dir) != 0:
-                return False
+        if writable_files and p4_force_sync_files(changelist, writable_files, workspace_dir) != 0:
+            return False
     else:
         print('Leaving files as is, use --force to force sync')
         for filename in writable_files:
@@ -222,7 +260,8 @@ def git_is_workspace_clean(workspace_dir):
 def git_add_all_files(workspace_dir):
     """Add all files to git."""
     res = run_with_output(['git', 'add', '.'], cwd=workspace_dir,
-                          on_output=echo_output_to_stream)
+                          on_output=echo_output_to_stream,
+                          capture_stdout=False, capture_stderr=False)
     return res.returncode == 0
 
 
@@ -232,7 +271,8 @@ def git_commit(message, workspace_dir, allow_empty=False):
     if allow_empty:
         args.append('--allow-empty')
     res = run_with_output(['git'] + args,
-                          cwd=workspace_dir, on_output=echo_output_to_stream)
+                          cwd=workspace_dir, on_output=echo_output_to_stream,
+                          capture_stdout=False, capture_stderr=False)
     return res.returncode == 0
 
 
@@ -244,8 +284,9 @@ def git_changelist_of_last_commit(workspace_dir):
         return None
 
     msg = res.stdout[0]
-    pattern = r"(\d+): p4 sync //\.\.\.@\1"
-    match = re.search(pattern, msg)
+    if 'p4 sync' not in msg:
+        return None
+    match = _CHANGELIST_RE.search(msg)
     if match:
         return int(match.group(1))
     else:
@@ -287,7 +328,7 @@ def get_latest_changelist_affecting_workspace(workspace_dir):
     # Parse the changelist number from the output
     # Format is typically: "Change 12345 on 2023/01/01 by user@workspace 'description'"
     line = res.stdout[0]
-    match = re.search(r'Change (\d+)', line)
+    match = _CHANGE_RE.search(line)
     if match:
         return (0, int(match.group(1)))
     else:
@@ -373,11 +414,12 @@ def sync_command(args):
         return 1
     print('')
 
-    if not git_is_workspace_clean(workspace_dir):
-        if not git_add_all_files(workspace_dir):
-            print('Failed to add all files to git')
-            return 1
-        print('')
+    # No git status first, git add scans the workspace for changes anyway
+    # and does nothing if it is clean
+    if not git_add_all_files(workspace_dir):
+        print('Failed to add all files to git')
+        return 1
+    print('')
 
     commit_msg = '%s: p4 sync //...@%s' % (args.changelist, args.changelist)
     if not git_commit(commit_msg, workspace_dir, allow_empty=True):